@@ -16,14 +16,46 @@ sorting and filtering.
                              db.document.summary,
                              db.document.total)
         return jsonify(dt_json(q, request.json))
+
+Textual columns are searched using ``ILIKE '%value%'``, which cannot use
+an ordinary B-tree index. On large PostgreSQL tables you can mark a column
+for an index-backed search through its ``info`` dictionary:
+
+.. code-block:: python
+
+    summary = Column(Text, info={'search_kind': 'tsvector'})
+
+The setting is honored for labelled columns as well.
+
+``tsvector``
+    Matches ``to_tsvector('simple', column) @@ plainto_tsquery('simple',
+    value)``. Requires an expression index::
+
+        CREATE INDEX ON document
+            USING gin (to_tsvector('simple', summary));
+
+``trigram``
+    Matches ``column % value``, i.e. trigram similarity. Requires the
+    ``pg_trgm`` extension and a trigram index::
+
+        CREATE EXTENSION pg_trgm;
+        CREATE INDEX ON document USING gin (summary gin_trgm_ops);
+
+    Please note that the default ``ILIKE`` search makes use of such an
+    index as well, so you only need this for fuzzy matching.
 """
 
 from datetime import datetime, date, time
 from numbers import Number
-from re import findall
+import re
+from time import monotonic
 
-from sqlalchemy import and_, or_
-from sqlalchemy.types import NullType
+from sqlalchemy import or_, false, func, bindparam, literal, inspect
+from sqlalchemy import literal_column
+from sqlalchemy.sql.expression import ClauseElement, Join
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.sql.visitors import iterate
+from sqlalchemy.types import NullType, String
 
 from flask import request
 from flask_babel import format_currency, lazy_gettext as _
@@ -33,6 +65,7 @@ __all__ = [
     'dt_json',
     'dt_query',
     'dt_language',
+    'count_total',
 ]
 
 
@@ -64,47 +97,248 @@ dt_language = {
 DataTables localization messages for your convenience.
 """
 
+TOTAL_TTL = 60
+"""
+Number of seconds for which :func:`dt_json` reuses a previously counted
+``recordsTotal`` when called with ``approx=True``.
+"""
+
+MAX_TERMS = 8
+"""
+Maximum number of words of the global search value that are used to
+filter the records. The rest is ignored.
+"""
+
+MAX_REGEX = 256
+"""
+Maximum length of a regular expression search value. Longer ones match
+no records at all.
+"""
+
+# Splits the global search value into words.
+_WORD_RE = re.compile(r'\S+')
+
+# Anything that looks like an integer or a decimal number.
+_NUMBER_RE = re.compile(r'\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*$')
+
+# Types of values passed through to the client as they are.
+_PLAIN_TYPES = frozenset([type(None), str, int, float, bool])
+
+# Text search configuration, inlined so that expression indexes match.
+_TS_CONFIG = literal_column("'simple'")
+
+# Label of the window function column carrying the filtered row count.
+_TOTAL_LABEL = '_dt_total'
 
-def dt_json(base, request):
+# Recently counted totals, keyed by the compiled base query.
+_totals = {}
+
+
+def dt_json(base, request, approx=False, data_as_array=False,
+            total_query=None):
     """
     Uses :func:`dt_query` to query the database and return an
     appropriate representation of the result for the DataTables client.
 
-    Applies the ``offset`` and ``limit`` constraints.
+    Applies the ``offset`` and ``limit`` constraints. Unless the query
+    is ``DISTINCT``, the number of matching records is obtained along
+    with the page itself using a ``COUNT(*) OVER ()`` window function.
 
     :param base: Base SQLAlchemy query to augment with request data.
     :param request: JSON object with the request data, usually taken
         straight from :attr:`flask.request.json`.
+    :param approx: Reuse ``recordsTotal`` counted for an identical base
+        query up to :data:`TOTAL_TTL` seconds ago instead of counting
+        all records again.
+    :param data_as_array: Return every record as an array of values
+        instead of an object. This makes the response considerably
+        smaller. Names of the columns are then returned as ``columns``
+        and the client should refer to them by position.
+    :param total_query: Query returning the total number of records as
+        a scalar, to be used instead of counting the base query records.
     """
 
     start = request['start']
     length = request['length']
 
     query = dt_query(base, request)
+    names = [column['name'] for column in query.column_descriptions]
+    filtered = None
     data = []
 
-    for row in query.offset(start).limit(length).all():
-        data.append({})
+    # The window would count rows before DISTINCT removes them.
+    windowed = not query.statement._distinct
 
-        for column in query.column_descriptions:
-            value = getattr(row, column['name'])
+    if windowed:
+        paged = query.add_columns(func.count().over().label(_TOTAL_LABEL))
+    else:
+        paged = query
 
-            if isinstance(value, datetime):
-                value = value.strftime('%Y-%m-%d %H:%M:%S')
-            elif isinstance(value, date):
-                value = value.strftime('%Y-%m-%d')
-            elif isinstance(value, time):
-                value = value.strftime('%H:%M:%S')
+    for row in paged.offset(start).limit(length).all():
+        if windowed:
+            filtered = row[-1]
+            row = row[:-1]
 
-            data[-1][column['name']] = value
-
-    return {
+        if data_as_array:
+            data.append(list(map(_format, row)))
+        else:
+            data.append(dict(zip(names, map(_format, row))))
+
+    if not windowed:
+        filtered = count_records(query)
+    elif filtered is None:
+        # Either nothing matches or the client paged past the end.
+        filtered = count_records(query) if start else 0
+
+    if total_query is not None:
+        total = total_query.scalar()
+    elif approx:
+        total = count_total(base)
+    else:
+        total = count_records(base)
+
+    result = {
         'draw': request['draw'],
-        'recordsTotal': base.count(),
-        'recordsFiltered': query.count(),
+        'recordsTotal': total,
+        'recordsFiltered': filtered,
         'data': data,
     }
 
+    if data_as_array:
+        result['columns'] = names
+
+    return result
+
+
+def _format(value):
+    if type(value) in _PLAIN_TYPES:
+        return value
+    elif isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    elif isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    elif isinstance(value, time):
+        return value.strftime('%H:%M:%S')
+
+    return value
+
+
+def count_records(query):
+    """
+    Count records returned by the query.
+
+    Unlike :meth:`~sqlalchemy.orm.query.Query.count`, this counts primary
+    keys of the entity of the first column directly instead of wrapping
+    the whole query in a subquery. This is only done when the query
+    selects from that entity's table, possibly extended with inner or
+    left outer joins, where the key can never be ``NULL``.
+
+    Queries with other joins, multiple sources, ``GROUP BY``, ``HAVING``,
+    ``DISTINCT``, ``LIMIT``, ``OFFSET`` or function calls (which might be
+    aggregates) among their columns as well as queries whose first column
+    does not belong to a mapped entity are counted the usual way.
+
+    :param query: SQLAlchemy query to count.
+    """
+
+    entity = query.column_descriptions[0]['entity']
+    select = query.statement
+
+    if entity is None \
+            or select._group_by_clause.clauses \
+            or _has_having(select) \
+            or select._distinct \
+            or select._limit_clause is not None \
+            or select._offset_clause is not None \
+            or _has_functions(query):
+        return query.count()
+
+    info = inspect(entity)
+
+    if getattr(info, 'is_aliased_class', False):
+        return query.count()
+
+    if hasattr(select, 'get_final_froms'):
+        froms = select.get_final_froms()
+    else:
+        froms = select.froms
+
+    if len(froms) != 1 or not _rooted_at(froms[0], info.persist_selectable):
+        return query.count()
+
+    # Count the mapped attribute rather than the bare table column,
+    # so that inheritance criteria and joins are kept.
+    prop = info.mapper.get_property_by_column(info.primary_key[0])
+    pkey = getattr(entity, prop.key)
+
+    return query.with_entities(func.count(pkey)).order_by(None).scalar()
+
+
+def _has_having(select):
+    if hasattr(select, '_having_criteria'):
+        return bool(select._having_criteria)
+
+    return select._having is not None
+
+
+def _has_functions(query):
+    for column in query.column_descriptions:
+        expr = column['expr']
+
+        if hasattr(expr, '__clause_element__'):
+            expr = expr.__clause_element__()
+
+        if not isinstance(expr, ClauseElement):
+            continue
+
+        for element in iterate(expr, {}):
+            if isinstance(element, FunctionElement):
+                return True
+
+    return False
+
+
+def _rooted_at(selectable, root):
+    # Walk down the left side of the joins. The root must never end up
+    # on the outer side of a join, where its primary key may be NULL.
+    while selectable is not root:
+        if not isinstance(selectable, Join) or selectable.full:
+            return False
+
+        selectable = selectable.left
+
+    return True
+
+
+def count_total(base):
+    """
+    Count records returned by the base query, reusing the result for
+    up to :data:`TOTAL_TTL` seconds for queries that compile to the same
+    statement with the same parameters and run against the same bind.
+
+    :param base: Base SQLAlchemy query to count.
+    """
+
+    statement = base.statement
+    bind = base.session.get_bind(clause=statement)
+    compiled = statement.compile()
+    key = (bind, str(compiled), repr(sorted(compiled.params.items())))
+    bucket = int(monotonic() // TOTAL_TTL)
+
+    # Another thread may clear the cache at any moment.
+    entry = _totals.get(key)
+
+    if entry is not None and entry[0] == bucket:
+        return entry[1]
+
+    if len(_totals) >= 128:
+        _totals.clear()
+
+    total = count_records(base)
+    _totals[key] = (bucket, total)
+
+    return total
+
 
 def dt_query(base, request):
     """
@@ -121,23 +355,15 @@ def dt_query(base, request):
     Does not include the ``offset`` and ``limit`` constraints.
     These need to be applied separately.
 
+    To keep the generated statement reasonably small, only the first
+    :data:`MAX_TERMS` words of the global search value are used and
+    regular expressions are limited by :data:`MAX_REGEX`.
+
     :param base: Base SQLAlchemy query to augment with data from
        :attr:`flask.request.json`.
     """
 
-    # Gather introspected column objects.
-    cdefs = {}
-
-    for column in base.column_descriptions:
-        assert column['name'] is not None, \
-            'One of the columns has no name. Use label() to name it.'
-
-        assert not isinstance(column['expr'].type, NullType), \
-            'Column {!r} is of an unknown type. Use type_coerce().' \
-            .format(column['name'])
-
-        cdefs[column['name']] = column['expr']
-
+    cdefs = get_cdefs(base)
     query = base
     terms = []
 
@@ -152,29 +378,36 @@ def dt_query(base, request):
         if value:
             terms.append(search(cdef, value, regex))
 
-    query = query.filter(and_(*terms))
+    if terms:
+        query = query.filter(*terms)
+
     terms = []
 
     regex = request['search']['regex']
     value = request['search']['value']
 
-    for word in findall(r'\S+', value):
-        maybe = []
+    # Resolve the searchable columns just once, each of them only once.
+    searchable = {}
 
-        for column in request['columns']:
-            if not column['searchable']:
-                continue
+    for column in request['columns']:
+        if not column['searchable']:
+            continue
 
-            if not column['data'] in cdefs:
-                continue
+        if column['data'] not in cdefs:
+            continue
 
-            cdef = cdefs[column['data']]
-            maybe.append(search(cdef, word, regex))
+        searchable[column['data']] = cdefs[column['data']]
 
-        terms.append(or_(*maybe))
+    if searchable:
+        for word in _WORD_RE.findall(value)[:MAX_TERMS]:
+            terms.append(or_(*[search(cdef, word, regex)
+                               for cdef in searchable.values()]))
+
+    if terms:
+        query = query.filter(*terms)
 
-    query = query.filter(and_(*terms))
     ordering = []
+    ordered = set()
 
     for order in request['order']:
         try:
@@ -182,40 +415,110 @@ def dt_query(base, request):
                 continue
 
             cdef = cdefs[request['columns'][order['column']]['data']]
-        except:
+        except (IndexError, KeyError, TypeError):
+            continue
+
+        # Sorting by the same column again cannot change the result.
+        if id(cdef) in ordered:
             continue
 
+        ordered.add(id(cdef))
+
         if order['dir'] == 'asc':
             ordering.append(cdef.asc())
         else:
             ordering.append(cdef.desc())
 
-    query = query.order_by(*ordering)
+    if ordering:
+        query = query.order_by(*ordering)
 
     return query
 
 
+def get_cdefs(base):
+    """
+    Map names of the base query columns to their expressions.
+    The expressions can also be looked up by column position.
+
+    :param base: Base SQLAlchemy query to introspect.
+    """
+
+    cdefs = {}
+
+    for position, column in enumerate(base.column_descriptions):
+        assert column['name'] is not None, \
+            'One of the columns has no name. Use label() to name it.'
+
+        assert not isinstance(column['expr'].type, NullType), \
+            'Column {!r} is of an unknown type. Use type_coerce().' \
+            .format(column['name'])
+
+        cdefs[column['name']] = column['expr']
+
+        # Array-shaped data are addressed by column position.
+        cdefs[position] = column['expr']
+
+    return cdefs
+
+
 def search(cdef, value, regex=False):
+    """
+    Build a condition matching the column against a search value.
+
+    The value is always passed as a bound parameter, so that statements
+    differing only in what the user has typed share the same SQL and
+    can be served from the SQLAlchemy compiled cache. Make sure that
+    the engine has not been created with ``query_cache_size=0``.
+
+    :param cdef: Column expression to match.
+    :param value: Search value as entered by the user.
+    :param regex: Match textual columns using the ``~`` operator.
+        Otherwise textual columns are matched according to their
+        ``search_kind`` (see above) and using ``ILIKE`` by default.
+    """
+
     ctype = cdef.type.python_type
 
     if issubclass(ctype, Number):
+        # Most text typed into a numeric column is not a number at all.
+        if not _NUMBER_RE.match(value):
+            return or_()
+
         try:
-            return cdef == ctype(value)
-        except:
+            return cdef == bindparam(None, ctype(value), type_=cdef.type)
+        except (ValueError, TypeError, ArithmeticError):
             pass
     elif issubclass(ctype, str):
+        # Labels do not carry info, the labelled column does.
+        info = getattr(cdef, 'info', None) \
+            or getattr(getattr(cdef, 'element', None), 'info', {})
+        kind = info.get('search_kind')
+
         if regex:
-            return cdef.op('~')(value)
+            if len(value) > MAX_REGEX:
+                return false()
+
+            return cdef.op('~')(bindparam(None, value, type_=String))
+        elif kind == 'tsvector':
+            query = func.plainto_tsquery(
+                _TS_CONFIG, bindparam(None, value, type_=String))
+            return func.to_tsvector(_TS_CONFIG, cdef).op('@@')(query)
+        elif kind == 'trigram':
+            return cdef.op('%')(bindparam(None, value, type_=String))
         else:
-            return cdef.ilike('%{}%'.format(value))
+            pattern = literal('%', type_=String) \
+                    + bindparam(None, value, type_=String) \
+                    + literal('%', type_=String)
+            return cdef.ilike(pattern)
     elif issubclass(ctype, list):
         ctype = cdef.type.item_type.python_type
 
         try:
             # This is not ideal, but I have no idea on how to match
             # array elements better, for example using ILIKE.
-            return cdef.op('&&')([ctype(value)])
-        except:
+            item = bindparam(None, [ctype(value)], type_=cdef.type)
+            return cdef.op('&&')(item)
+        except (ValueError, TypeError, ArithmeticError):
             pass
 
     return or_()